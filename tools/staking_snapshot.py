@@ -5,7 +5,7 @@ from decimal import Decimal
 from typing import Set
 #from .bsc_users import BSC_USERS
 
-from .utils import enable_logging, get_web3, load_abi, get_closest_block, retryable, to_address, get_events
+from .utils import enable_logging, get_web3, load_abi, get_closest_block, retryable, to_address, iter_events
 
 PAYRUE_STAKING_ABI = load_abi('PayRueStaking')
 ERC20_ABI = load_abi('IERC20')
@@ -53,7 +53,7 @@ def determine_stakers(
     web3 = get_web3(rpc_url)
     print(f"Chain {chain}, rpc url {rpc_url}")
     print("Determining block closest to", snapshot_datetime)
-    closest_block = get_closest_block(web3, snapshot_datetime, not_before=True)
+    closest_block = get_closest_block(web3, snapshot_datetime, not_before=True, use_cache=True)
     snapshot_block_number = closest_block['number']
     print(
         "Closest block:",
@@ -105,16 +105,17 @@ def load_user_addresses(*, chain, staking_contract, start_block, snapshot_block_
     print(f"Loading Staking events from {start_block} to {snapshot_block_number} to determine users")
     #if chain == 'BSC':
     #    return BSC_USERS
-    events = get_events(
+    user_addresses = set()
+    num_events = 0
+    for e in iter_events(
         event=staking_contract.events.Staked(),
         from_block=start_block,
         to_block=snapshot_block_number,
-    )
-    print(len(events), 'events')
-    return set(
-        e.args['user']
-        for e in events
-    )
+    ):
+        user_addresses.add(e.args['user'])
+        num_events += 1
+    print(num_events, 'events')
+    return user_addresses
 
 
 if __name__ == '__main__':
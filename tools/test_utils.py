@@ -0,0 +1,560 @@
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from aiohttp import ClientResponseError
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError
+from web3 import HTTPProvider, Web3
+
+from tools import utils
+
+
+# Never connected to, the fake fetch functions below stand in for the node
+WEB3 = Web3(HTTPProvider('http://127.0.0.1:1'))
+
+
+STAKING_ADDRESS = '0x0DC8c9726e7651aFa4D7294Fb2A3d7eE1436DD4a'
+
+
+class FakeNode(ThreadingHTTPServer):
+    """JSON-RPC endpoint on localhost that answers each request with the result of handle(request).
+
+    handle can raise ValueError(error) to answer with a JSON-RPC error. respond can be replaced to answer
+    whole request bodies (e.g. batches) at once.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _FakeNodeRequestHandler)
+        self.url = f'http://127.0.0.1:{self.server_port}'
+        self.bodies = []
+        self.handle = lambda request: None
+        self.respond = self.respond_each
+
+    def respond_each(self, body):
+        if isinstance(body, list):
+            return [self.respond_each(request) for request in body]
+        try:
+            return {'jsonrpc': '2.0', 'id': body['id'], 'result': self.handle(body)}
+        except ValueError as e:
+            return {'jsonrpc': '2.0', 'id': body['id'], 'error': e.args[0]}
+
+
+class _FakeNodeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.bodies.append(body)
+        data = json.dumps(self.server.respond(body)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting
+            pass
+
+
+@pytest.fixture
+def node():
+    node = FakeNode()
+    threading.Thread(target=node.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True).start()
+    yield node
+    node.shutdown()
+    node.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(utils, 'exponential_sleep', sleeps.append)
+    return sleeps
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f'{status} error', response=response)
+
+
+def make_fetch(fail):
+    """Make a fetch function for _iter_in_batches whose events are the block numbers divisible by 7.
+
+    fail(block_ranges, call_number) returns the exception to raise for a call, or None.
+    """
+    lock = threading.Lock()
+    calls = []
+
+    def fetch(block_ranges, *, retries):
+        assert retries == 0
+        with lock:
+            calls.append(block_ranges)
+            error = fail(block_ranges, len(calls))
+        if error is not None:
+            raise error
+        return [n for start, end in block_ranges for n in range(start, end + 1) if n % 7 == 0]
+
+    fetch.calls = calls
+    return fetch
+
+
+def iter_in_batches(fetch, **kwargs):
+    kwargs = {
+        'web3': WEB3,
+        'fetch': fetch,
+        'from_block': 0,
+        'to_block': 5_000,
+        'batch_size': 200,
+        'max_workers': 4,
+        'rpc_batch_size': 3,
+        'min_batch_size': 1,
+        'max_batch_size': 1_000,
+        **kwargs,
+    }
+    return list(utils._iter_in_batches(**kwargs))
+
+
+def test_iter_in_batches_returns_events_in_order():
+    fetch = make_fetch(lambda block_ranges, call_number: None)
+    assert iter_in_batches(fetch) == list(range(0, 5_001, 7))
+
+
+def test_iter_in_batches_refetches_failed_batches_in_order(sleeps):
+    def fail(block_ranges, call_number):
+        if any(end - start > 50 for start, end in block_ranges):
+            return ValueError({'code': -32005, 'message': 'query returned more than 10000 results'})
+
+    fetch = make_fetch(fail)
+    assert iter_in_batches(fetch) == list(range(0, 5_001, 7))
+    assert sleeps == []
+
+
+def test_iter_in_batches_backs_off_on_other_errors(sleeps):
+    def fail(block_ranges, call_number):
+        if call_number <= 2:
+            return requests.ConnectionError('connection refused')
+
+    fetch = make_fetch(fail)
+    assert iter_in_batches(fetch, max_workers=1, rpc_batch_size=1) == list(range(0, 5_001, 7))
+    assert sleeps == [1, 2]
+    # The batch size was not reduced by the connection errors
+    assert fetch.calls[:3] == [[(0, 200)]] * 3
+
+
+def test_iter_in_batches_backs_off_on_rate_limits(sleeps):
+    def fail(block_ranges, call_number):
+        if call_number == 1:
+            return ValueError({'code': -32005, 'message': 'project ID request rate exceeded'})
+
+    fetch = make_fetch(fail)
+    assert iter_in_batches(fetch, max_workers=1, rpc_batch_size=1) == list(range(0, 5_001, 7))
+    assert sleeps == [1]
+    assert fetch.calls[:2] == [[(0, 200)]] * 2
+
+
+def test_iter_in_batches_raises_after_retries(sleeps):
+    fetch = make_fetch(lambda block_ranges, call_number: requests.ConnectionError('connection refused'))
+    with pytest.raises(requests.ConnectionError):
+        iter_in_batches(fetch, retries=2)
+    assert sleeps == [1, 2]
+
+
+def test_iter_in_batches_grows_batch_size_up_to_max_batch_size():
+    fetch = make_fetch(lambda block_ranges, call_number: None)
+    iter_in_batches(fetch, to_block=200_000, max_batch_size=300)
+    assert max(end - start for block_ranges in fetch.calls for start, end in block_ranges) == 300
+
+
+@pytest.mark.parametrize('error, expected', [
+    (ValueError({'code': -32005, 'message': 'query returned more than 10000 results'}), True),
+    (ValueError({'code': -32000, 'message': 'exceed maximum block range: 5000'}), True),
+    (ValueError({'code': -32602, 'message': 'Log response size exceeded.'}), True),
+    (ValueError({'code': -32000, 'message': 'query timeout exceeded'}), True),
+    (requests.ReadTimeout('read timed out'), True),
+    (requests.ConnectionError(MaxRetryError(None, '/', ReadTimeoutError(None, '/', 'read timed out'))), True),
+    (http_error(413), True),
+    (ValueError({'code': -32005, 'message': 'project ID request rate exceeded'}), False),
+    (ValueError({'code': 429, 'message': 'Too Many Requests'}), False),
+    (ValueError({'code': -32000, 'message': 'daily request limit reached'}), False),
+    (ValueError({'code': -32000, 'message': 'Monthly capacity limit exceeded'}), False),
+    (ValueError({'code': -32000, 'message': 'quota exceeded'}), False),
+    (ValueError('execution reverted: out of range'), False),
+    (requests.ConnectionError('connection refused'), False),
+    (requests.ConnectTimeout('connect timed out'), False),
+    (http_error(429), False),
+    (http_error(502), False),
+])
+def test_is_batch_size_error(error, expected):
+    assert utils._is_batch_size_error(error) == expected
+
+
+def test_get_events_shrinks_batches_on_read_timeouts(node, sleeps):
+    def handle(request):
+        assert request['method'] == 'eth_getLogs'
+        filter_params = request['params'][0]
+        if int(filter_params['toBlock'], 16) - int(filter_params['fromBlock'], 16) > 300:
+            time.sleep(1)
+        return []
+
+    node.handle = handle
+    web3 = utils.get_web3(node.url, provider_kwargs={'request_kwargs': {'timeout': 0.2}})
+    staking = web3.eth.contract(address=STAKING_ADDRESS, abi=utils.load_abi('PayRueStaking'))
+    events = utils.get_events(
+        event=staking.events.Staked(),
+        from_block=0,
+        to_block=3_000,
+        max_workers=2,
+        rpc_batch_size=2,
+    )
+    assert events == []
+    # The read timeouts reached get_events, which shrank the batches instead of backing off
+    assert sleeps == []
+
+
+def test_validate_batch_args_defaults_max_batch_size():
+    assert utils._validate_batch_args(0, 10, 1_000, 1, None) == utils.DEFAULT_MAX_BATCH_SIZE
+    assert utils._validate_batch_args(0, 10, 20_000, 1, None) == 20_000
+    with pytest.raises(ValueError):
+        utils._validate_batch_args(0, 10, 20_000, 1, 10_000)
+    with pytest.raises(ValueError):
+        utils._validate_batch_args(10, 0, 1_000, 1, None)
+
+
+def search_closest_block(timestamps, wanted_timestamp, **kwargs):
+    """Drive _search_closest_block over blocks 1..len(timestamps) - 1, returning the result and the probe rounds"""
+    rounds = []
+    search = utils._search_closest_block(wanted_timestamp, 1, len(timestamps) - 1, **kwargs)
+    try:
+        block_numbers = next(search)
+        while True:
+            rounds.append(block_numbers)
+            block_numbers = search.send([timestamps[n] for n in block_numbers])
+    except StopIteration as e:
+        return e.value, rounds
+
+
+def assert_closest(timestamps, wanted_timestamp, block_number):
+    best_diff = min(abs(timestamp - wanted_timestamp) for timestamp in timestamps[1:])
+    assert abs(timestamps[block_number] - wanted_timestamp) == best_diff
+
+
+# Block 0 is never probed
+REGULAR_TIMESTAMPS = [None] + [1_600_000_000 + 3 * n for n in range(1, 100_001)]
+
+
+def test_search_closest_block_exact_match():
+    block_number, rounds = search_closest_block(REGULAR_TIMESTAMPS, REGULAR_TIMESTAMPS[12_345])
+    assert block_number == 12_345
+    # Interpolation finds the block right after probing the ends of the range
+    assert len(rounds) == 2
+
+
+def test_search_closest_block_between_blocks():
+    block_number, _ = search_closest_block(REGULAR_TIMESTAMPS, REGULAR_TIMESTAMPS[12_345] + 1)
+    assert block_number == 12_345
+    block_number, _ = search_closest_block(REGULAR_TIMESTAMPS, REGULAR_TIMESTAMPS[12_345] + 2)
+    assert block_number == 12_346
+
+
+def test_search_closest_block_before_first_block():
+    block_number, _ = search_closest_block(REGULAR_TIMESTAMPS, REGULAR_TIMESTAMPS[1] - 1_000)
+    assert block_number == 1
+
+
+def test_search_closest_block_after_head():
+    block_number, _ = search_closest_block(REGULAR_TIMESTAMPS, REGULAR_TIMESTAMPS[-1] + 1_000)
+    assert block_number == len(REGULAR_TIMESTAMPS) - 1
+
+
+def test_search_closest_block_empty_range():
+    search = utils._search_closest_block(1_600_000_000, 10, 9)
+    with pytest.raises(StopIteration) as e:
+        next(search)
+    assert e.value.value is None
+
+
+@pytest.mark.parametrize('probes_per_round', [1, 3, 7])
+def test_search_closest_block_drifting_block_times(probes_per_round):
+    rng = random.Random(probes_per_round)
+    # Block times change from ~15s to ~3s halfway through, with some jitter and blocks sharing a timestamp
+    timestamps = [None]
+    timestamp = 1_500_000_000
+    for n in range(1, 50_001):
+        timestamp += rng.randint(10, 20) if n < 25_000 else rng.randint(0, 6)
+        timestamps.append(timestamp)
+
+    for _ in range(50):
+        wanted_timestamp = rng.randint(timestamps[1] - 100, timestamps[-1] + 100)
+        block_number, rounds = search_closest_block(
+            timestamps,
+            wanted_timestamp,
+            probes_per_round=probes_per_round,
+        )
+        assert_closest(timestamps, wanted_timestamp, block_number)
+        assert all(len(block_numbers) <= max(2, probes_per_round) for block_numbers in rounds)
+        assert all(block_numbers == sorted(block_numbers) for block_numbers in rounds)
+        # Bounded by the interpolation rounds plus a bisect of the whole range
+        assert len(rounds) <= 6 + len(timestamps).bit_length()
+
+
+def get_logs_by_from_block(request):
+    """handle for FakeNode returning one log in the first block of each eth_getLogs range"""
+    assert request['method'] == 'eth_getLogs'
+    return [{'blockNumber': request['params'][0]['fromBlock'], 'logIndex': '0x0'}]
+
+
+def get_log_batches(web3, block_ranges, **kwargs):
+    log_batches = utils.get_log_batches_with_retries(
+        web3,
+        [{'fromBlock': hex(start), 'toBlock': hex(end)} for start, end in block_ranges],
+        retries=0,
+        **kwargs,
+    )
+    return [[log['blockNumber'] for log in logs] for logs in log_batches]
+
+
+def test_get_log_batches_matches_responses_by_id(node):
+    node.handle = get_logs_by_from_block
+    node.respond = lambda body: list(reversed(node.respond_each(body)))
+    web3 = utils.get_web3(node.url)
+    assert get_log_batches(web3, [(0, 9), (10, 19), (20, 29)]) == [[0], [10], [20]]
+    assert len(node.bodies) == 1 and len(node.bodies[0]) == 3
+
+
+@pytest.mark.parametrize('respond', [
+    # Dropped response
+    lambda responses: responses[:-1],
+    # Duplicated id
+    lambda responses: [responses[0], {**responses[1], 'id': 0}, responses[2]],
+    # Extra response
+    lambda responses: responses + [{**responses[0], 'id': 3}],
+])
+def test_get_log_batches_rejects_mismatched_responses(node, respond):
+    node.handle = get_logs_by_from_block
+    node.respond = lambda body: respond(node.respond_each(body))
+    web3 = utils.get_web3(node.url)
+    with pytest.raises(ValueError, match='invalid batch response'):
+        get_log_batches(web3, [(0, 9), (10, 19), (20, 29)])
+
+
+def test_get_log_batches_sends_single_filter_without_batch(node):
+    node.handle = get_logs_by_from_block
+    web3 = utils.get_web3(node.url)
+    assert get_log_batches(web3, [(0, 9)]) == [[0]]
+    assert isinstance(node.bodies[0], dict)
+
+
+def test_get_log_batches_falls_back_when_batches_are_not_supported(node):
+    def respond(body):
+        if isinstance(body, list):
+            error = {'code': -32600, 'message': 'batch requests are not supported'}
+            return {'jsonrpc': '2.0', 'id': None, 'error': error}
+        return node.respond_each(body)
+
+    node.handle = get_logs_by_from_block
+    node.respond = respond
+    web3 = utils.get_web3(node.url)
+    assert get_log_batches(web3, [(0, 9), (10, 19)]) == [[0], [10]]
+    assert get_log_batches(web3, [(20, 29), (30, 39)]) == [[20], [30]]
+    # Only the first batch was attempted
+    assert [isinstance(body, list) for body in node.bodies] == [True, False, False, False, False]
+
+
+def test_get_events_reduces_requests_per_batch_when_batch_is_too_large(node, sleeps):
+    def respond(body):
+        if isinstance(body, list) and len(body) > 2:
+            return {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32005, 'message': 'batch size limit exceeded'}}
+        return node.respond_each(body)
+
+    node.handle = lambda request: []
+    node.respond = respond
+    web3 = utils.get_web3(node.url)
+    staking = web3.eth.contract(address=STAKING_ADDRESS, abi=utils.load_abi('PayRueStaking'))
+    utils.get_events(
+        event=staking.events.Staked(),
+        from_block=0,
+        to_block=20_000,
+        batch_size=1_000,
+        max_workers=1,
+        rpc_batch_size=8,
+    )
+    assert sleeps == []
+    requests_per_body = [len(body) if isinstance(body, list) else 1 for body in node.bodies]
+    assert requests_per_body[:3] == [8, 4, 2]
+    assert max(requests_per_body[3:]) == 2
+    # The block ranges were not shrunk
+    first_request = node.bodies[2][0]
+    assert (first_request['params'][0]['fromBlock'], first_request['params'][0]['toBlock']) == ('0x0', hex(1_000))
+
+
+def handle_chain(chain_id, head_block_number=100_000):
+    """Make a FakeNode handle for a chain with 3 second blocks"""
+    def handle(request):
+        method, params = request['method'], request['params']
+        if method == 'eth_chainId':
+            return hex(chain_id)
+        if method == 'eth_blockNumber':
+            return hex(head_block_number)
+        if method in ('eth_getBlockByNumber', 'eth_getHeaderByNumber'):
+            block_number = int(params[0], 16)
+            return {
+                'number': hex(block_number),
+                'hash': '0x%064x' % (block_number + 1),
+                'timestamp': hex(1_600_000_000 + 3 * block_number),
+            }
+        raise ValueError({'code': -32601, 'message': f'the method {method} does not exist/is not available'})
+    return handle
+
+
+@pytest.fixture
+def timestamp_cache(tmp_path, monkeypatch):
+    path = tmp_path / 'cache' / 'block_timestamps.sqlite3'
+    monkeypatch.setattr(utils, 'BLOCK_TIMESTAMP_CACHE_PATH', str(path))
+    monkeypatch.setattr(utils._BlockTimestampCache, '_default', None)
+    monkeypatch.setattr(utils._BlockTimestampCache, '_default_failed', False)
+    return path
+
+
+def test_block_timestamps_skips_blocks_near_head(tmp_path):
+    cache = utils._BlockTimestampCache(str(tmp_path / 'cache.sqlite3'))
+    head_block_number = 1_000
+    cutoff = head_block_number - utils.BLOCK_TIMESTAMP_CACHE_CONFIRMATIONS
+    timestamps = utils._BlockTimestamps(cache, '56:0x01', head_block_number)
+    assert timestamps.missing([1, cutoff, cutoff + 1]) == [1, cutoff, cutoff + 1]
+    for block_number in [1, cutoff, cutoff + 1]:
+        timestamps.add(block_number, 1_600_000_000 + block_number)
+    assert timestamps.missing([1, cutoff, cutoff + 1]) == []
+
+    timestamps = utils._BlockTimestamps(cache, '56:0x01', head_block_number)
+    assert timestamps.missing([1, cutoff, cutoff + 1]) == [cutoff + 1]
+    assert timestamps[cutoff] == 1_600_000_000 + cutoff
+    # Other chains, or the same chain id with another genesis block, don't share the timestamps
+    assert utils._BlockTimestamps(cache, '56:0x02', head_block_number).missing([1]) == [1]
+    assert utils._BlockTimestamps(cache, None, head_block_number).missing([1]) == [1]
+
+
+def test_block_timestamp_cache_degrades_on_sqlite_errors(tmp_path):
+    cache = utils._BlockTimestampCache(str(tmp_path / 'cache.sqlite3'))
+    cache.set('56:0x01', 1, 1_600_000_000)
+    cache._connection.close()
+    assert cache.get('56:0x01', 1) is None
+    cache.set('56:0x01', 2, 1_600_000_003)
+
+
+def test_block_timestamp_cache_default_is_created(timestamp_cache):
+    cache = utils._BlockTimestampCache.get_default()
+    assert cache is not None
+    assert utils._BlockTimestampCache.get_default() is cache
+    assert timestamp_cache.exists()
+
+
+def test_block_timestamp_cache_default_degrades_on_unusable_path(tmp_path, monkeypatch, timestamp_cache):
+    not_a_dir = tmp_path / 'file'
+    not_a_dir.write_text('')
+    monkeypatch.setattr(utils, 'BLOCK_TIMESTAMP_CACHE_PATH', str(not_a_dir / 'block_timestamps.sqlite3'))
+    assert utils._BlockTimestampCache.get_default() is None
+
+
+def test_get_chain_key_is_memoized(node):
+    node.handle = handle_chain(56)
+    web3 = utils.get_web3(node.url)
+    assert utils._get_chain_key(web3) == '56:0x%064x' % 1
+    assert utils._get_chain_key(web3) == '56:0x%064x' % 1
+    assert [body['method'] for body in node.bodies] == ['eth_chainId', 'eth_getBlockByNumber']
+
+
+def test_get_chain_key_skips_dev_chains(node):
+    node.handle = handle_chain(31337)
+    web3 = utils.get_web3(node.url)
+    assert utils._get_chain_key(web3) is None
+    assert utils._get_chain_key(web3) is None
+    assert [body['method'] for body in node.bodies] == ['eth_chainId']
+
+
+def test_get_closest_block_uses_cache(node, timestamp_cache):
+    node.handle = handle_chain(56)
+    web3 = utils.get_web3(node.url)
+    wanted_datetime = datetime.fromtimestamp(1_600_000_000 + 3 * 12_345, timezone.utc)
+    assert utils.get_closest_block(web3, wanted_datetime, use_cache=True)['number'] == 12_345
+
+    del node.bodies[:]
+    assert utils.get_closest_block(web3, wanted_datetime, use_cache=True)['number'] == 12_345
+    # Only the head and the result are fetched, the head is too recent to be cached
+    assert sorted(body['method'] for body in node.bodies) == [
+        'eth_blockNumber',
+        'eth_getBlockByNumber',
+        'eth_getHeaderByNumber',
+    ]
+
+
+def test_get_closest_block_does_not_cache_by_default(node, timestamp_cache):
+    node.handle = handle_chain(56)
+    web3 = utils.get_web3(node.url)
+    utils.get_closest_block(web3, datetime.fromtimestamp(1_600_000_000 + 3 * 12_345, timezone.utc))
+    assert not timestamp_cache.exists()
+
+
+@pytest.mark.parametrize('error, expected', [
+    (ValueError({'code': -32601, 'message': 'Method not found'}), True),
+    (ValueError({'code': -32000, 'message': 'the method eth_getHeaderByNumber does not exist/is not available'}), True),
+    (ValueError({'code': -32000, 'message': 'Unsupported method: eth_getHeaderByNumber'}), True),
+    (http_error(404), True),
+    (http_error(501), True),
+    (ClientResponseError(None, (), status=405), True),
+    (ValueError({'code': -32005, 'message': 'project ID request rate exceeded'}), False),
+    (ValueError({'code': -32000, 'message': 'header not found'}), False),
+    (ValueError('invalid response'), False),
+    (http_error(429), False),
+    (http_error(503), False),
+    (ClientResponseError(None, (), status=429), False),
+])
+def test_is_method_not_found_error(error, expected):
+    assert utils._is_method_not_found_error(error) == expected
+
+
+def test_get_block_timestamp_falls_back_to_get_block(node):
+    handle = handle_chain(56)
+
+    def handle_without_headers(request):
+        if request['method'] == 'eth_getHeaderByNumber':
+            raise ValueError({'code': -32601, 'message': 'Method not found'})
+        return handle(request)
+
+    node.handle = handle_without_headers
+    web3 = utils.get_web3(node.url)
+    assert utils._get_block_timestamp(web3, 10) == 1_600_000_030
+    assert utils._get_block_timestamp(web3, 11) == 1_600_000_033
+    assert [body['method'] for body in node.bodies] == [
+        'eth_getHeaderByNumber',
+        'eth_getBlockByNumber',
+        'eth_getBlockByNumber',
+    ]
+
+
+def test_get_block_timestamp_keeps_headers_after_transient_errors(node):
+    handle = handle_chain(56)
+
+    def handle_rate_limited(request):
+        if len(node.bodies) == 1:
+            raise ValueError({'code': -32005, 'message': 'project ID request rate exceeded'})
+        return handle(request)
+
+    node.handle = handle_rate_limited
+    web3 = utils.get_web3(node.url)
+    # Without the retries of retryable
+    with pytest.raises(ValueError):
+        utils._get_block_timestamp.__wrapped__(web3, 10)
+    assert web3 not in utils._NO_HEADER_BY_NUMBER
+    assert utils._get_block_timestamp.__wrapped__(web3, 10) == 1_600_000_030
+    assert [body['method'] for body in node.bodies] == ['eth_getHeaderByNumber', 'eth_getHeaderByNumber']
@@ -1,29 +1,74 @@
+import asyncio
 import functools
+import inspect
 import json
 import logging
 import os
+import random
+import re
+import sqlite3
 import sys
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from time import sleep
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, Generator, Iterator, List, Optional, Tuple, Union
 
+from aiohttp import ClientResponseError
 from eth_account.signers.local import LocalAccount
 from eth_typing import AnyAddress
-from eth_utils import to_checksum_address
-from web3 import Web3
+from eth_utils import encode_hex, event_abi_to_log_topic, to_checksum_address
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError
+from urllib3.util.retry import Retry
+from web3 import AsyncHTTPProvider, HTTPProvider, Web3
+from web3._utils.filters import construct_event_filter_params
+from web3._utils.method_formatters import log_entry_formatter, to_integer_if_hex
+from web3._utils.request import cache_session, make_post_request
 from web3.contract import ContractEvent
+from web3.eth import AsyncEth
 from web3.middleware import construct_sign_and_send_raw_middleware, geth_poa_middleware
-from web3.types import BlockData
+from web3.types import BlockData, EventData, FilterParams, LogReceipt
+
+# orjson parses integers wider than 64 bits as floats, so it is only used for payloads known to be free of them:
+# ABI files and the eth_getLogs batch responses (where all values are hex strings)
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 logger = logging.getLogger(__name__)
 THIS_DIR = os.path.dirname(__file__)
 ABI_DIR = os.path.join(THIS_DIR, 'abi')
+_ABI_NAMES = frozenset(f[:-len('.json')] for f in os.listdir(ABI_DIR) if f.endswith('.json'))
+BLOCK_TIMESTAMP_CACHE_PATH = os.getenv(
+    'BLOCK_TIMESTAMP_CACHE_PATH',
+    os.path.join(os.path.expanduser('~'), '.cache', 'payrue-staking', 'block_timestamps.sqlite3'),
+)
+# Blocks closer to the head than this might still get reorged, so their timestamps are not cached
+BLOCK_TIMESTAMP_CACHE_CONFIRMATIONS = 100
+# Default upper bound of the adaptive eth_getLogs batch size, see iter_events
+DEFAULT_MAX_BATCH_SIZE = 10_000
 
 
 def get_web3(rpc_url: str, *, account: Optional[LocalAccount] = None, provider_kwargs=None) -> Web3:
     if provider_kwargs is None:
         provider_kwargs = {}
-    web3 = Web3(Web3.HTTPProvider(rpc_url, **provider_kwargs))
+    session = provider_kwargs.get('session') or _get_http_session()
+    provider_kwargs = {
+        **provider_kwargs,
+        'session': session,
+        'request_kwargs': {
+            'timeout': 30,
+            **provider_kwargs.get('request_kwargs', {}),
+        },
+    }
+    provider = Web3.HTTPProvider(rpc_url, **provider_kwargs)
+    _PROVIDER_SESSIONS[provider] = session
+    web3 = Web3(provider)
     if account:
         set_web3_account(
             web3=web3,
@@ -39,17 +84,82 @@ def get_web3(rpc_url: str, *, account: Optional[LocalAccount] = None, provider_k
     return web3
 
 
+# Session of each provider created by get_web3, see _get_thread_pool
+_PROVIDER_SESSIONS: 'weakref.WeakKeyDictionary[HTTPProvider, requests.Session]' = weakref.WeakKeyDictionary()
+
+
+def _get_thread_pool(web3: Web3, max_workers: int) -> ThreadPoolExecutor:
+    """Get a thread pool whose threads send their requests through the HTTP session of web3's provider.
+
+    web3.py caches HTTP sessions per thread, so worker threads would otherwise each get a plain session,
+    without the connection pool and retry settings from get_web3 and without keep-alive between pools.
+    """
+    provider = web3.provider
+    session = _PROVIDER_SESSIONS.get(provider)
+    if session is None:
+        return ThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=cache_session,
+        initargs=(provider.endpoint_uri, session),
+    )
+
+
+def _get_http_session() -> requests.Session:
+    # Shared by all threads using the provider (see _get_thread_pool), so the pool must fit
+    # the concurrent requests in get_events.
+    # Only failures where the node never processed the request are retried here: connection errors and
+    # HTTP 429/503. This covers every request sent through this session, on the thread that created the provider
+    # and in pools from _get_thread_pool. Read errors are not retried, since the node might have acted on the
+    # request already (e.g. eth_sendRawTransaction), and a read timeout tells get_events to shrink its batches.
+    # JSON-RPC errors returned with HTTP 200 (e.g. -32005 rate limits of some providers) are not retried here.
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=5,
+            read=False,
+            other=0,
+            backoff_factor=0.5,
+            status_forcelist=[429, 503],
+            # JSON-RPC requests are all POSTs, which urllib3 does not retry by default
+            allowed_methods=['POST'],
+            # Let the last 429/503 response through, so it raises requests.HTTPError as without retries
+            raise_on_status=False,
+        ),
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_async_web3(rpc_url: str, *, provider_kwargs=None) -> Web3:
+    """Get a Web3 instance with an AsyncHTTPProvider, for use with the *_async functions"""
+    if provider_kwargs is None:
+        provider_kwargs = {}
+    # Async Web3 does not support the sync middlewares, so no POA middleware here (nor is it needed without them)
+    return Web3(
+        AsyncHTTPProvider(rpc_url, **provider_kwargs),
+        modules={'eth': (AsyncEth,)},
+        middlewares=[],
+    )
+
+
 def set_web3_account(*, web3: Web3, account: LocalAccount) -> Web3:
     web3.middleware_onion.add(construct_sign_and_send_raw_middleware(account))
     web3.eth.default_account = account.address
     return web3
 
 
+@functools.lru_cache(maxsize=None)
 def load_abi(name: str) -> List[Dict[str, Any]]:
-    abi_path = os.path.join(ABI_DIR, f'{name}.json')
-    assert os.path.abspath(abi_path).startswith(os.path.abspath(ABI_DIR))
-    with open(abi_path) as f:
-        return json.load(f)
+    """Load an ABI from the abi directory. The result is cached and shared between callers, so don't mutate it"""
+    # Only names of files in the abi directory are accepted, so name cannot escape it
+    if name not in _ABI_NAMES:
+        raise FileNotFoundError(f'ABI {name!r} not found in {ABI_DIR}')
+    with open(os.path.join(ABI_DIR, f'{name}.json'), 'rb') as f:
+        return _json_loads(f.read())
 
 
 def get_events(
@@ -58,75 +168,565 @@ def get_events(
     from_block: int,
     to_block: int,
     batch_size: int = 1_000,
-    argument_filters=None
+    argument_filters=None,
+    max_workers: int = 8,
+    rpc_batch_size: int = 10,
+    min_batch_size: int = 1,
+    max_batch_size: Optional[int] = None,
+) -> List[EventData]:
+    """Load events in batches and return them as a list. See iter_events"""
+    return list(iter_events(
+        event=event,
+        from_block=from_block,
+        to_block=to_block,
+        batch_size=batch_size,
+        argument_filters=argument_filters,
+        max_workers=max_workers,
+        rpc_batch_size=rpc_batch_size,
+        min_batch_size=min_batch_size,
+        max_batch_size=max_batch_size,
+    ))
+
+
+def iter_events(
+    *,
+    event: ContractEvent,
+    from_block: int,
+    to_block: int,
+    batch_size: int = 1_000,
+    argument_filters=None,
+    max_workers: int = 8,
+    rpc_batch_size: int = 10,
+    min_batch_size: int = 1,
+    max_batch_size: Optional[int] = None,
+) -> Iterator[EventData]:
+    """Load events in batches, fetching up to max_workers batches concurrently.
+
+    Block ranges are sent rpc_batch_size at a time as a single JSON-RPC batch request.
+    The batch size starts at batch_size and adapts to the node, see _iter_in_batches. max_batch_size defaults
+    to the larger of DEFAULT_MAX_BATCH_SIZE and batch_size.
+    Events are yielded as each round of batches completes, so only one round is kept in memory.
+    """
+    max_batch_size = _validate_batch_args(from_block, to_block, batch_size, min_batch_size, max_batch_size)
+    return _iter_in_batches(
+        web3=event.web3,
+        fetch=functools.partial(
+            get_event_batches_with_retries,
+            event,
+            filter_params=get_event_filter_params(event, argument_filters=argument_filters),
+        ),
+        from_block=from_block,
+        to_block=to_block,
+        batch_size=batch_size,
+        max_workers=max_workers,
+        rpc_batch_size=rpc_batch_size,
+        min_batch_size=min_batch_size,
+        max_batch_size=max_batch_size,
+    )
+
+
+async def get_events_async(
+    *,
+    web3: Web3,
+    event: ContractEvent,
+    from_block: int,
+    to_block: int,
+    batch_size: int = 1_000,
+    argument_filters=None,
+    max_concurrency: int = 8,
+    retries: int = 10,
 ):
-    """Load events in batches"""
+    """Load events in batches using an async Web3 instance, with up to max_concurrency requests in flight.
+
+    event is only used to build the filter and decode the logs, so it can belong to a regular (sync) contract.
+    """
     if to_block < from_block:
         raise ValueError(f'to_block {to_block} is smaller than from_block {from_block}')
 
     logger.info('fetching events from %s to %s with batch size %s', from_block, to_block, batch_size)
-    ret = []
-    batch_from_block = from_block
-    while batch_from_block <= to_block:
-        batch_to_block = min(batch_from_block + batch_size, to_block)
-        logger.info('fetching batch from %s to %s (up to %s)', batch_from_block, batch_to_block, to_block)
+    filter_params = get_event_filter_params(event, argument_filters=argument_filters)
+    semaphore = asyncio.Semaphore(max_concurrency)
 
-        events = get_event_batch_with_retries(
-            event=event,
-            from_block=batch_from_block,
-            to_block=batch_to_block,
-            argument_filters=argument_filters,
-        )
+    async def fetch_batch(batch_from_block: int, batch_to_block: int):
+        batch_filter_params: FilterParams = {
+            **filter_params,
+            'fromBlock': batch_from_block,
+            'toBlock': batch_to_block,
+        }
+        async with semaphore:
+            logger.info('fetching batch from %s to %s (up to %s)', batch_from_block, batch_to_block, to_block)
+            for attempt in range(retries):
+                try:
+                    logs = await web3.eth.get_logs(batch_filter_params)
+                    break
+                except Exception as e:
+                    logger.warning('error in get_events_async: %s, retrying (%s)', e, retries - attempt)
+                    await exponential_sleep_async(attempt + 1)
+            else:
+                logs = await web3.eth.get_logs(batch_filter_params)
+        events = [event.process_log(log) for log in logs]
         if len(events) > 0:
             logger.info(f'found %s events in batch', len(events))
-        ret.extend(events)
-        batch_from_block = batch_to_block + 1
+        return events
+
+    # gather returns results in the order of the awaitables, so events stay sorted by block
+    event_batches = await asyncio.gather(*(
+        fetch_batch(batch_from_block, batch_to_block)
+        for batch_from_block, batch_to_block in get_block_ranges(from_block, to_block, batch_size)
+    ))
+    ret = [e for events in event_batches for e in events]
     logger.info(f'found %s events in total', len(ret))
     return ret
 
 
-def get_event_batch_with_retries(event, from_block, to_block, *, argument_filters=None, retries=10):
-    initial_retries = retries
-    while True:
+def get_multi_events(
+    *,
+    events: List[ContractEvent],
+    from_block: int,
+    to_block: int,
+    batch_size: int = 1_000,
+    max_workers: int = 8,
+    rpc_batch_size: int = 10,
+    min_batch_size: int = 1,
+    max_batch_size: Optional[int] = None,
+):
+    """Load events of multiple types with a single eth_getLogs per block range.
+
+    The events are fetched with an OR-filter on topic0 and returned in the order they were emitted.
+    """
+    if not events:
+        raise ValueError('at least one event is required')
+    max_batch_size = _validate_batch_args(from_block, to_block, batch_size, min_batch_size, max_batch_size)
+    return list(_iter_in_batches(
+        web3=events[0].web3,
+        fetch=functools.partial(get_multi_event_batches_with_retries, events),
+        from_block=from_block,
+        to_block=to_block,
+        batch_size=batch_size,
+        max_workers=max_workers,
+        rpc_batch_size=rpc_batch_size,
+        min_batch_size=min_batch_size,
+        max_batch_size=max_batch_size,
+    ))
+
+
+def _validate_batch_args(
+    from_block: int,
+    to_block: int,
+    batch_size: int,
+    min_batch_size: int,
+    max_batch_size: Optional[int],
+) -> int:
+    """Validate the arguments of the batched event getters and return max_batch_size, defaulted if None"""
+    if max_batch_size is None:
+        max_batch_size = max(DEFAULT_MAX_BATCH_SIZE, batch_size)
+    if to_block < from_block:
+        raise ValueError(f'to_block {to_block} is smaller than from_block {from_block}')
+    if not 1 <= min_batch_size <= batch_size <= max_batch_size:
+        raise ValueError(
+            f'batch_size {batch_size} must be between min_batch_size {min_batch_size} '
+            f'and max_batch_size {max_batch_size}'
+        )
+    return max_batch_size
+
+
+def _iter_in_batches(
+    *,
+    web3: Web3,
+    fetch: Callable[..., List[EventData]],
+    from_block: int,
+    to_block: int,
+    batch_size: int,
+    max_workers: int,
+    rpc_batch_size: int,
+    min_batch_size: int,
+    max_batch_size: int,
+    retries: int = 10,
+) -> Iterator[EventData]:
+    """Fetch events in rounds of up to max_workers JSON-RPC batch requests.
+
+    The batch size is adapted AIMD-style: it grows by 25% after each round without errors and is halved
+    when a request fails because of the size of the batch (see _is_batch_size_error), in which case the range
+    is retried from the first failed batch. Response times of eth_getLogs grow steeply with the number of events
+    in range, so this finds a size the node can serve. If the node rejects a JSON-RPC batch for the number of
+    requests in it, rpc_batch_size is halved instead. Other errors are retried with exponential backoff.
+    """
+    logger.info('fetching events from %s to %s with batch size %s', from_block, to_block, batch_size)
+
+    def fetch_rpc_batch(rpc_batch: List[Tuple[int, int]]) -> Tuple[bool, Any]:
+        logger.info(
+            'fetching batch from %s to %s (up to %s)',
+            rpc_batch[0][0],
+            rpc_batch[-1][1],
+            to_block
+        )
         try:
-            return event.getLogs(
-                fromBlock=from_block,
-                toBlock=to_block,
-                argument_filters=argument_filters
+            events = fetch(rpc_batch, retries=0)
+        except Exception as e:
+            return False, e
+        if len(events) > 0:
+            logger.info(f'found %s events in batch', len(events))
+        return True, events
+
+    num_events = 0
+    batch_from_block = from_block
+    current_batch_size = batch_size
+    attempt = 0
+    with _get_thread_pool(web3, max_workers) as executor:
+        while batch_from_block <= to_block:
+            block_ranges = get_block_ranges(
+                batch_from_block,
+                to_block,
+                current_batch_size,
+                max_ranges=max_workers * rpc_batch_size,
             )
+            rpc_batches = [
+                block_ranges[i:i + rpc_batch_size]
+                for i in range(0, len(block_ranges), rpc_batch_size)
+            ]
+            # map yields results in submission order, so events stay sorted by block
+            for rpc_batch, (ok, result) in zip(rpc_batches, executor.map(fetch_rpc_batch, rpc_batches)):
+                if not ok:
+                    error = result
+                    break
+                num_events += len(result)
+                yield from result
+                batch_from_block = rpc_batch[-1][1] + 1
+            else:
+                attempt = 0
+                current_batch_size = min(max_batch_size, max(current_batch_size + 1, int(current_batch_size * 1.25)))
+                continue
+
+            if isinstance(error, _BatchTooLargeError) and rpc_batch_size > 1:
+                # Fewer requests per batch, the block ranges were not the problem
+                rpc_batch_size = max(1, rpc_batch_size // 2)
+                logger.warning('error in get_events: %s, retrying with %s requests per batch', error, rpc_batch_size)
+                continue
+            # Errors unrelated to the size of the batch (connection errors, rate limits, ...) are backed off from,
+            # as are size errors once the batch cannot be made any smaller
+            if _is_batch_size_error(error) and current_batch_size > min_batch_size:
+                current_batch_size = max(min_batch_size, current_batch_size // 2)
+                logger.warning('error in get_events: %s, retrying with batch size %s', error, current_batch_size)
+                continue
+            if attempt >= retries:
+                raise error
+            attempt += 1
+            logger.warning('error in get_events: %s, retrying (%s)', error, retries - attempt)
+            exponential_sleep(attempt)
+    logger.info(f'found %s events in total', num_events)
+
+
+def _is_batch_size_error(e: Exception) -> bool:
+    """Whether e suggests that an eth_getLogs request failed because its block range was too large.
+
+    Nodes don't agree on an error code for this, so the message is checked, e.g. "query returned more than
+    10000 results", "exceed maximum block range: 5000", "Log response size exceeded", "query timeout exceeded".
+    """
+    if isinstance(e, requests.ReadTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError):
+        # A session retrying read errors (not the one from get_web3) wraps the timeout in a MaxRetryError
+        reason = e.args[0] if e.args else None
+        return isinstance(reason, MaxRetryError) and isinstance(reason.reason, ReadTimeoutError)
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code == 413
+    if not isinstance(e, ValueError):
+        return False
+    error = e.args[0] if e.args else None
+    message = str(error.get('message', '') if isinstance(error, dict) else error).lower()
+    # Infura uses the same error code for rate limits, e.g. "project ID request rate exceeded"
+    if _RATE_LIMIT_RE.search(message):
+        return False
+    return any(s in message for s in _BATCH_SIZE_ERROR_MESSAGES)
+
+
+_RATE_LIMIT_RE = re.compile(r'\brate\b|\brequest count\b|\bcapacity\b|\bquota\b|too many requests|limit reached')
+_BATCH_SIZE_ERROR_MESSAGES = (
+    'more than',
+    'too many results',
+    'too many logs',
+    'block range',
+    'blocks range',
+    'response size',
+    'query timeout',
+)
+
+
+def get_block_ranges(
+    from_block: int,
+    to_block: int,
+    batch_size: int,
+    *,
+    max_ranges: Optional[int] = None
+) -> List[Tuple[int, int]]:
+    ret = []
+    batch_from_block = from_block
+    while batch_from_block <= to_block and (max_ranges is None or len(ret) < max_ranges):
+        batch_to_block = min(batch_from_block + batch_size, to_block)
+        ret.append((batch_from_block, batch_to_block))
+        batch_from_block = batch_to_block + 1
+    return ret
+
+
+def get_event_batches_with_retries(
+    event: ContractEvent,
+    block_ranges: List[Tuple[int, int]],
+    *,
+    argument_filters=None,
+    filter_params: Optional[FilterParams] = None,
+    retries=10
+) -> List[EventData]:
+    """Fetch events for multiple block ranges in one JSON-RPC batch request.
+
+    Pass filter_params from get_event_filter_params to avoid re-encoding the filter for every call.
+    """
+    if filter_params is None:
+        filter_params = get_event_filter_params(event, argument_filters=argument_filters)
+    filter_params_list = [
+        {
+            **filter_params,
+            'fromBlock': hex(batch_from_block),
+            'toBlock': hex(batch_to_block),
+        }
+        for batch_from_block, batch_to_block in block_ranges
+    ]
+
+    log_batches = get_log_batches_with_retries(event.web3, filter_params_list, retries=retries)
+    return [
+        event.process_log(log)
+        for logs in log_batches
+        for log in logs
+    ]
+
+
+def get_event_filter_params(event: ContractEvent, *, argument_filters=None) -> FilterParams:
+    """Build the eth_getLogs filter (address and topics) for event, without the block range"""
+    _, filter_params = construct_event_filter_params(
+        event._get_event_abi(),
+        event.web3.codec,
+        contract_address=event.address,
+        argument_filters=argument_filters,
+    )
+    return filter_params
+
+
+def get_multi_event_batches_with_retries(
+    events: List[ContractEvent],
+    block_ranges: List[Tuple[int, int]],
+    *,
+    retries=10
+) -> List[EventData]:
+    """Fetch events of multiple types for multiple block ranges in one JSON-RPC batch request"""
+    web3 = events[0].web3
+    events_by_address_and_topic = {
+        (event.address, event_abi_to_log_topic(event._get_event_abi())): event
+        for event in events
+    }
+    addresses = list(dict.fromkeys(event.address for event in events))
+    topics = list(dict.fromkeys(encode_hex(topic) for _, topic in events_by_address_and_topic))
+    filter_params_list = [
+        {
+            'address': addresses,
+            'topics': [topics],
+            'fromBlock': hex(batch_from_block),
+            'toBlock': hex(batch_to_block),
+        }
+        for batch_from_block, batch_to_block in block_ranges
+    ]
+
+    log_batches = get_log_batches_with_retries(web3, filter_params_list, retries=retries)
+    ret = []
+    for logs in log_batches:
+        for log in logs:
+            event = events_by_address_and_topic.get((log['address'], bytes(log['topics'][0])))
+            if event is None:
+                # Same topic0 but for an event of another address in the filter
+                continue
+            ret.append(event.process_log(log))
+    return ret
+
+
+# Web3 instances connected to nodes that reject JSON-RPC batch requests
+_NO_BATCH_REQUESTS: 'weakref.WeakSet[Web3]' = weakref.WeakSet()
+
+
+class _BatchTooLargeError(ValueError):
+    """A node rejected a JSON-RPC batch request because it contained too many requests"""
+
+
+def _is_batch_too_large_error(error: Dict[str, Any]) -> bool:
+    # e.g. "batch size limit exceeded", "too many requests in batch", "batch too large"
+    message = str(error.get('message', '')).lower()
+    return 'batch' in message and any(
+        s in message for s in ('too large', 'too many', 'too big', 'limit', 'exceed', 'maximum')
+    )
+
+
+def _is_batch_not_supported_error(error: Dict[str, Any]) -> bool:
+    # e.g. -32600 "batch requests are not supported", "batch requests disabled"
+    message = str(error.get('message', '')).lower()
+    if _RATE_LIMIT_RE.search(message):
+        return False
+    return error.get('code') == -32600 or 'batch' in message
+
+
+def get_log_batches_with_retries(
+    web3: Web3,
+    filter_params_list: List[FilterParams],
+    *,
+    retries=10
+) -> List[List[LogReceipt]]:
+    """Fetch raw logs for multiple filters, in one JSON-RPC batch request if the provider and node support it.
+
+    Raises _BatchTooLargeError if the node rejects the batch for the number of requests in it.
+    """
+    provider = web3.provider
+    if isinstance(provider, HTTPProvider) and len(filter_params_list) > 1:
+        rpc_requests = [
+            {
+                'jsonrpc': '2.0',
+                'id': request_id,
+                'method': 'eth_getLogs',
+                'params': [filter_params],
+            }
+            for request_id, filter_params in enumerate(filter_params_list)
+        ]
+        request_data = json.dumps(rpc_requests).encode()
+    else:
+        request_data = None
+
+    def fetch() -> List[List[LogReceipt]]:
+        if request_data is None or web3 in _NO_BATCH_REQUESTS:
+            # JSON-RPC batching needs raw HTTP access, fall back to one request per filter
+            return [web3.eth.get_logs(filter_params) for filter_params in filter_params_list]
+
+        raw_response = make_post_request(
+            provider.endpoint_uri,
+            request_data,
+            **provider.get_request_kwargs()
+        )
+        responses = _json_loads(raw_response)
+        if not isinstance(responses, list):
+            # Nodes answer a rejected batch with a single error object
+            error = responses.get('error') if isinstance(responses, dict) else None
+            if not isinstance(error, dict):
+                raise ValueError(f'invalid batch response: {responses}')
+            if _is_batch_too_large_error(error):
+                raise _BatchTooLargeError(error)
+            if _is_batch_not_supported_error(error):
+                logger.warning('JSON-RPC batch requests not supported, sending one request per filter: %s', error)
+                _NO_BATCH_REQUESTS.add(web3)
+                return fetch()
+            raise ValueError(error)
+        # Responses can come in any order, and a node might drop some of them. Matching them by position
+        # would silently skip block ranges, so require exactly one response per request.
+        responses_by_id = {
+            response.get('id'): response
+            for response in responses
+            if isinstance(response, dict)
+        }
+        if len(responses) != len(filter_params_list) or responses_by_id.keys() != set(range(len(filter_params_list))):
+            raise ValueError(
+                f'invalid batch response: got ids {sorted(map(str, responses_by_id))} '
+                f'for {len(filter_params_list)} requests'
+            )
+        ret = []
+        for request_id in range(len(filter_params_list)):
+            response = responses_by_id[request_id]
+            if 'error' in response:
+                raise ValueError(response['error'])
+            ret.append([log_entry_formatter(log) for log in response['result']])
+        return ret
+
+    for attempt in range(retries):
+        try:
+            return fetch()
+        except Exception as e:
+            logger.warning('error in get_log_batches: %s, retrying (%s)', e, retries - attempt)
+            exponential_sleep(attempt + 1)
+    return fetch()
+
+
+def get_event_batch_with_retries(
+    event,
+    from_block,
+    to_block,
+    *,
+    argument_filters=None,
+    filter_params: Optional[FilterParams] = None,
+    retries=10
+):
+    if filter_params is None:
+        filter_params = get_event_filter_params(event, argument_filters=argument_filters)
+    filter_params = {
+        **filter_params,
+        'fromBlock': from_block,
+        'toBlock': to_block,
+    }
+    for attempt in range(retries):
+        try:
+            logs = event.web3.eth.get_logs(filter_params)
+            break
         except Exception as e:
-            if retries <= 0:
-                raise e
-            logger.warning('error in get_all_entries: %s, retrying (%s)', e, retries)
-            retries -= 1
-            exponential_sleep(initial_retries - retries)
+            logger.warning('error in get_all_entries: %s, retrying (%s)', e, retries - attempt)
+            exponential_sleep(attempt + 1)
+    else:
+        logs = event.web3.eth.get_logs(filter_params)
+    return [event.process_log(log) for log in logs]
 
 
 def exponential_sleep(attempt, max_sleep_time=256.0):
+    sleep(_get_exponential_sleep_time(attempt, max_sleep_time))
+
+
+async def exponential_sleep_async(attempt, max_sleep_time=256.0):
+    await asyncio.sleep(_get_exponential_sleep_time(attempt, max_sleep_time))
+
+
+def _get_exponential_sleep_time(attempt, max_sleep_time):
     sleep_time = min(2 ** attempt, max_sleep_time)
-    sleep(sleep_time)
+    # Add up to 25% of jitter so that concurrent workers don't all retry at the same time
+    return sleep_time + random.uniform(0, sleep_time * 0.25)
 
 
 def retryable(*, max_attempts: int = 10):
     def decorator(func):
+        # Bound once here instead of looked up as globals on every retry
+        _log = logger.warning
+
+        if inspect.iscoroutinefunction(func):
+            _sleep_async = exponential_sleep_async
+
+            @functools.wraps(func)
+            async def wrapped_async(*args, **kwargs):
+                for attempt in range(max_attempts):
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception as e:
+                        _log('Retryable error (attempt: %s/%s): %s', attempt + 1, max_attempts, e)
+                        await _sleep_async(attempt)
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    _log('max attempts (%s) exchusted for error: %s', max_attempts, e)
+                    raise
+            return wrapped_async
+
+        _sleep = exponential_sleep
+
         @functools.wraps(func)
         def wrapped(*args, **kwargs):
-            attempt = 0
-            while True:
+            for attempt in range(max_attempts):
                 try:
                     return func(*args, **kwargs)
                 except Exception as e:
-                    if attempt >= max_attempts:
-                        logger.warning('max attempts (%s) exchusted for error: %s', max_attempts, e)
-                        raise
-                    logger.warning(
-                        'Retryable error (attempt: %s/%s): %s',
-                        attempt + 1,
-                        max_attempts,
-                        e,
-                        )
-                    exponential_sleep(attempt)
-                    attempt += 1
+                    _log('Retryable error (attempt: %s/%s): %s', attempt + 1, max_attempts, e)
+                    _sleep(attempt)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                _log('max attempts (%s) exchusted for error: %s', max_attempts, e)
+                raise
         return wrapped
     return decorator
 
@@ -138,63 +738,418 @@ def to_address(a: Union[bytes, str]) -> AnyAddress:
     return to_checksum_address(a)
 
 
-@functools.lru_cache()
-@retryable()
+# Keyed by Web3 instance first, since the same address can be a contract on one chain and not on another.
+# Weak keys make sure the cached addresses are dropped together with the Web3 instance.
+_IS_CONTRACT_CACHE: 'weakref.WeakKeyDictionary[Web3, Dict[str, bool]]' = weakref.WeakKeyDictionary()
+
+
 def is_contract(*, web3: Web3, address: str) -> bool:
-    code = web3.eth.get_code(to_address(address))
-    return code != b'\x00' and code != b''
+    address = to_address(address)
+    try:
+        return _IS_CONTRACT_CACHE[web3][address]
+    except KeyError:
+        pass
+    code = web3.eth.get_code(address)
+    ret = code != b'\x00' and code != b''
+    _IS_CONTRACT_CACHE.setdefault(web3, {})[address] = ret
+    return ret
 
 
 def get_closest_block(
     web3: Web3,
     wanted_datetime: datetime,
     *,
-    not_before: bool = False
+    not_before: bool = False,
+    use_cache: bool = False,
+    probes_per_round: int = 3,
 ) -> BlockData:
+    """Find the block with timestamp closest to wanted_datetime.
+
+    The bisect probes probes_per_round evenly spaced blocks concurrently per round, which takes
+    log(N) / log(probes_per_round + 1) rounds instead of log2(N).
+    Probes fetch only block headers (see _get_block_timestamp), the full block is fetched once for the result.
+    With use_cache, block timestamps are persisted in the block timestamp cache at BLOCK_TIMESTAMP_CACHE_PATH
+    (see _BlockTimestampCache), so repeated searches on the same chain mostly skip the RPC calls.
+    """
     wanted_timestamp = int(wanted_datetime.timestamp())
     logger.debug("Wanted timestamp: %s", wanted_timestamp)
     start_block_number = 1
     end_block_number = web3.eth.block_number
     logger.debug("Bisecting between %s and %s", start_block_number, end_block_number)
-    closest_block = None
-    closest_diff = 2**256 - 1
-    while start_block_number <= end_block_number:
-        target_block_number = (start_block_number + end_block_number) // 2
-        block: BlockData = web3.eth.get_block(target_block_number)
-        block_timestamp = block['timestamp']
-
-        diff = block_timestamp - wanted_timestamp
-        logger.debug(
-            "target: %s, timestamp: %s, diff %s",
-            target_block_number,
-            block_timestamp,
-            diff
-        )
+    cache = _BlockTimestampCache.get_default() if use_cache else None
+    chain = _get_chain_key(web3) if cache is not None else None
+    timestamps = _BlockTimestamps(cache, chain, end_block_number)
+    # The first rounds of the search probe two blocks at a time. The pool threads share the provider's
+    # session, so the probes keep its transport retries and connections
+    executor = _get_thread_pool(web3, max(2, probes_per_round))
 
-        # Only update block when diff actually gets lower
-        # This is only necessary in the last steps of the bisect, but we might as well do it every round
-        if abs(diff) < closest_diff:
-            closest_diff = abs(diff)
-            closest_block = block
-
-        if block_timestamp > wanted_timestamp:
-            # block is after wanted, move end
-            end_block_number = block['number'] - 1
-        elif block_timestamp < wanted_timestamp:
-            # block is before wanted, move start
-            start_block_number = block['number'] + 1
-        else:
-            # timestamps are exactly the same, just return block
-            return block
+    def get_block_timestamps(block_numbers: List[int]) -> List[int]:
+        missing = timestamps.missing(block_numbers)
+        fetched = executor.map(functools.partial(_get_block_timestamp, web3), missing)
+        for block_number, timestamp in zip(missing, fetched):
+            timestamps.add(block_number, timestamp)
+        return [timestamps[n] for n in block_numbers]
+
+    search = _search_closest_block(
+        wanted_timestamp,
+        start_block_number,
+        end_block_number,
+        probes_per_round=probes_per_round,
+    )
+    with executor:
+        try:
+            block_numbers = next(search)
+            while True:
+                block_numbers = search.send(get_block_timestamps(block_numbers))
+        except StopIteration as e:
+            closest_block_number = e.value
 
-    if closest_block is None:
+    if closest_block_number is None:
         raise LookupError('Unable to determine block closest to ' + wanted_datetime.isoformat())
 
-    if not_before and closest_block["timestamp"] < wanted_timestamp:
+    if not_before and timestamps[closest_block_number] < wanted_timestamp:
         logger.debug("Block is before wanted timestamp and not_before=True, returning next block")
-        return web3.eth.get_block(closest_block["number"] + 1)
+        return web3.eth.get_block(closest_block_number + 1)
+
+    return web3.eth.get_block(closest_block_number)
+
+
+async def get_closest_block_async(
+    web3: Web3,
+    wanted_datetime: datetime,
+    *,
+    not_before: bool = False,
+    probes_per_round: int = 3,
+    use_cache: bool = False,
+) -> BlockData:
+    """Like get_closest_block, but for an async Web3 instance.
+
+    Each round of the bisect fetches probes_per_round blocks concurrently, so with the default of 3 a round
+    both probes the middle block and prefetches the middle blocks of the halves, halving the number of round-trips.
+    """
+    wanted_timestamp = int(wanted_datetime.timestamp())
+    logger.debug("Wanted timestamp: %s", wanted_timestamp)
+    start_block_number = 1
+    end_block_number = await web3.eth.block_number
+    logger.debug("Bisecting between %s and %s", start_block_number, end_block_number)
+    cache = _BlockTimestampCache.get_default() if use_cache else None
+    chain = (await _get_chain_key_async(web3)) if cache is not None else None
+    timestamps = _BlockTimestamps(cache, chain, end_block_number)
+
+    async def get_block_timestamps(block_numbers: List[int]) -> List[int]:
+        missing = timestamps.missing(block_numbers)
+        fetched = await asyncio.gather(*(_get_block_timestamp_async(web3, n) for n in missing))
+        for block_number, timestamp in zip(missing, fetched):
+            timestamps.add(block_number, timestamp)
+        return [timestamps[n] for n in block_numbers]
+
+    search = _search_closest_block(
+        wanted_timestamp,
+        start_block_number,
+        end_block_number,
+        probes_per_round=probes_per_round,
+    )
+    try:
+        block_numbers = next(search)
+        while True:
+            block_numbers = search.send(await get_block_timestamps(block_numbers))
+    except StopIteration as e:
+        closest_block_number = e.value
+
+    if closest_block_number is None:
+        raise LookupError('Unable to determine block closest to ' + wanted_datetime.isoformat())
+
+    if not_before and timestamps[closest_block_number] < wanted_timestamp:
+        logger.debug("Block is before wanted timestamp and not_before=True, returning next block")
+        return await web3.eth.get_block(closest_block_number + 1)
+
+    return await web3.eth.get_block(closest_block_number)
+
+
+# Web3 instances connected to nodes without eth_getHeaderByNumber
+_NO_HEADER_BY_NUMBER: 'weakref.WeakSet[Web3]' = weakref.WeakSet()
+
+
+@retryable(max_attempts=5)
+def _get_block_timestamp(web3: Web3, block_number: int) -> int:
+    """Get the timestamp of a block.
+
+    Uses eth_getHeaderByNumber (Geth, Erigon) when the node supports it, since the header is a fraction
+    of the size of the full block returned by eth_getBlockByNumber, and falls back to get_block otherwise.
+    Errors that are not covered by the transport retries, e.g. JSON-RPC rate limits, are retried here.
+    """
+    if web3 not in _NO_HEADER_BY_NUMBER:
+        try:
+            header = web3.manager.request_blocking('eth_getHeaderByNumber', [hex(block_number)])
+        except (ValueError, requests.HTTPError) as e:
+            if not _is_method_not_found_error(e):
+                raise
+            logger.debug('eth_getHeaderByNumber not supported, using eth_getBlockByNumber: %s', e)
+            _NO_HEADER_BY_NUMBER.add(web3)
+        else:
+            return to_integer_if_hex(header['timestamp'])
+    return web3.eth.get_block(block_number)['timestamp']
+
+
+@retryable(max_attempts=5)
+async def _get_block_timestamp_async(web3: Web3, block_number: int) -> int:
+    """Like _get_block_timestamp, but for an async Web3 instance"""
+    if web3 not in _NO_HEADER_BY_NUMBER:
+        try:
+            header = await web3.manager.coro_request('eth_getHeaderByNumber', [hex(block_number)])
+        except (ValueError, ClientResponseError) as e:
+            if not _is_method_not_found_error(e):
+                raise
+            logger.debug('eth_getHeaderByNumber not supported, using eth_getBlockByNumber: %s', e)
+            _NO_HEADER_BY_NUMBER.add(web3)
+        else:
+            return to_integer_if_hex(header['timestamp'])
+    return (await web3.eth.get_block(block_number))['timestamp']
+
+
+def _is_method_not_found_error(e: Exception) -> bool:
+    """Whether e is how a node or gateway answers a JSON-RPC method it does not implement"""
+    if isinstance(e, requests.HTTPError):
+        status = e.response.status_code if e.response is not None else None
+    elif isinstance(e, ClientResponseError):
+        status = e.status
+    else:
+        status = None
+    if status is not None:
+        # Some gateways reject unknown methods with an HTTP error. Rate limiting (429) and server errors are transient
+        return status in (400, 404, 405, 501)
+
+    error = e.args[0] if e.args else None
+    if not isinstance(error, dict):
+        return False
+    if error.get('code') == -32601:
+        return True
+    # e.g. "the method eth_getHeaderByNumber does not exist/is not available", "Unsupported method: ..."
+    message = str(error.get('message', '')).lower()
+    return 'method' in message and any(
+        s in message for s in ('not found', 'does not exist', 'not available', 'not supported', 'unsupported')
+    )
+
+
+class _BlockTimestampCache:
+    """Persistent (chain, block number) -> timestamp cache, stored in SQLite.
+
+    Chains are keyed by chain id and genesis block hash (see _get_chain_key), since the chain id alone
+    does not tell apart e.g. two runs of a local development node.
+    Errors from SQLite or the file system are logged and treated as cache misses.
+    """
+    _default: Optional['_BlockTimestampCache'] = None
+    _default_failed = False
+    _default_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS chain_block_timestamps ('
+                'chain TEXT NOT NULL, '
+                'block_number INTEGER NOT NULL, '
+                'timestamp INTEGER NOT NULL, '
+                'PRIMARY KEY (chain, block_number))'
+            )
+
+    @classmethod
+    def get_default(cls) -> Optional['_BlockTimestampCache']:
+        """Get the cache at BLOCK_TIMESTAMP_CACHE_PATH, or None if it cannot be opened"""
+        with cls._default_lock:
+            if cls._default is None and not cls._default_failed:
+                try:
+                    cache_dir = os.path.dirname(BLOCK_TIMESTAMP_CACHE_PATH)
+                    if cache_dir:
+                        os.makedirs(cache_dir, exist_ok=True)
+                    cls._default = cls(BLOCK_TIMESTAMP_CACHE_PATH)
+                except (OSError, sqlite3.Error) as e:
+                    logger.warning('Unable to open block timestamp cache %s: %s', BLOCK_TIMESTAMP_CACHE_PATH, e)
+                    cls._default_failed = True
+            return cls._default
+
+    def get(self, chain: str, block_number: int) -> Optional[int]:
+        try:
+            with self._lock:
+                row = self._connection.execute(
+                    'SELECT timestamp FROM chain_block_timestamps WHERE chain = ? AND block_number = ?',
+                    (chain, block_number),
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('Unable to read block timestamp cache: %s', e)
+            return None
+        return row[0] if row else None
+
+    def set(self, chain: str, block_number: int, timestamp: int) -> None:
+        try:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO chain_block_timestamps (chain, block_number, timestamp) VALUES (?, ?, ?)',
+                    (chain, block_number, timestamp),
+                )
+        except sqlite3.Error as e:
+            logger.warning('Unable to write block timestamp cache: %s', e)
+
+
+# Chain ids of local development nodes (Ganache, Hardhat), whose chains are not worth caching
+_DEV_CHAIN_IDS = frozenset({1337, 31337})
+
+
+# Memoized results of _get_chain_key, the genesis block of a node's chain does not change
+_CHAIN_KEYS: 'weakref.WeakKeyDictionary[Web3, Optional[str]]' = weakref.WeakKeyDictionary()
+
+
+def _get_chain_key(web3: Web3) -> Optional[str]:
+    """Get the key of web3's chain in the block timestamp cache, or None if it should not be cached"""
+    try:
+        return _CHAIN_KEYS[web3]
+    except KeyError:
+        pass
+    chain_id = web3.eth.chain_id
+    if chain_id in _DEV_CHAIN_IDS:
+        ret = None
+    else:
+        ret = '%s:%s' % (chain_id, encode_hex(web3.eth.get_block(0)['hash']))
+    _CHAIN_KEYS[web3] = ret
+    return ret
+
+
+async def _get_chain_key_async(web3: Web3) -> Optional[str]:
+    """Like _get_chain_key, but for an async Web3 instance"""
+    try:
+        return _CHAIN_KEYS[web3]
+    except KeyError:
+        pass
+    chain_id = await web3.eth.chain_id
+    if chain_id in _DEV_CHAIN_IDS:
+        ret = None
+    else:
+        ret = '%s:%s' % (chain_id, encode_hex((await web3.eth.get_block(0))['hash']))
+    _CHAIN_KEYS[web3] = ret
+    return ret
+
+
+class _BlockTimestamps:
+    """Block timestamps seen by one closest block search, read from and written to the block timestamp cache"""
+
+    def __init__(self, cache: Optional[_BlockTimestampCache], chain: Optional[str], head_block_number: int):
+        if chain is None:
+            cache = None
+        self._cache = cache
+        self._chain = chain
+        # Blocks this far behind the head are not expected to be reorged
+        self._last_cacheable_block_number = head_block_number - BLOCK_TIMESTAMP_CACHE_CONFIRMATIONS
+        self._timestamps: Dict[int, int] = {}
+
+    def __getitem__(self, block_number: int) -> int:
+        return self._timestamps[block_number]
+
+    def missing(self, block_numbers: List[int]) -> List[int]:
+        """Get the block numbers whose timestamps are neither known nor cached"""
+        if self._cache is not None:
+            for block_number in block_numbers:
+                if block_number not in self._timestamps:
+                    timestamp = self._cache.get(self._chain, block_number)
+                    if timestamp is not None:
+                        self._timestamps[block_number] = timestamp
+        return [n for n in block_numbers if n not in self._timestamps]
+
+    def add(self, block_number: int, timestamp: int) -> None:
+        self._timestamps[block_number] = timestamp
+        if self._cache is not None and block_number <= self._last_cacheable_block_number:
+            self._cache.set(self._chain, block_number, timestamp)
+
+
+def _search_closest_block(
+    wanted_timestamp: int,
+    start_block_number: int,
+    end_block_number: int,
+    *,
+    probes_per_round: int = 1,
+    max_interpolation_rounds: int = 4,
+) -> Generator[List[int], List[int], Optional[int]]:
+    """Search for the number of the block with timestamp closest to wanted_timestamp.
+
+    Yields sorted lists of block numbers to probe and expects their timestamps to be sent back, so that the
+    same search can be driven by both sync and async code. Returns None if the range is empty.
+
+    Block times are roughly constant, so the search first interpolates the wanted block from the timestamps of
+    the closest probes below and above it. From the second interpolation round on it probes around the estimate,
+    using the distance the estimate moved as the margin, which brackets the wanted block in a few rounds.
+    The rest is a regular bisect with probes_per_round evenly spaced probes per round.
+    """
+    closest_block_number = None
+    closest_diff = 2**256 - 1
+    # (block number, timestamp) of the closest probes before and after the wanted timestamp
+    lower: Optional[Tuple[int, int]] = None
+    upper: Optional[Tuple[int, int]] = None
+    estimate = None
+    interpolation_rounds = 0
+    while start_block_number <= end_block_number:
+        if lower is None and upper is None:
+            # First round: probe both ends of the range
+            target_block_numbers = sorted({start_block_number, end_block_number})
+        elif (
+            lower is not None and upper is not None
+            and interpolation_rounds < max_interpolation_rounds
+        ):
+            interpolation_rounds += 1
+            lower_block_number, lower_timestamp = lower
+            upper_block_number, upper_timestamp = upper
+            new_estimate = lower_block_number + (
+                (wanted_timestamp - lower_timestamp)
+                * (upper_block_number - lower_block_number)
+                // (upper_timestamp - lower_timestamp)
+            )
+            if estimate is None:
+                target_block_numbers = [new_estimate]
+            else:
+                margin = max(1, abs(new_estimate - estimate))
+                target_block_numbers = [new_estimate - margin, new_estimate + margin]
+            estimate = new_estimate
+            target_block_numbers = sorted({
+                min(max(n, start_block_number), end_block_number)
+                for n in target_block_numbers
+            })
+            logger.debug("Interpolated block %s", estimate)
+        else:
+            span = end_block_number - start_block_number
+            target_block_numbers = sorted({
+                start_block_number + (i * span) // (probes_per_round + 1)
+                for i in range(1, probes_per_round + 1)
+            })
+        block_timestamps = yield target_block_numbers
+
+        for target_block_number, block_timestamp in zip(target_block_numbers, block_timestamps):
+            diff = block_timestamp - wanted_timestamp
+            logger.debug(
+                "target: %s, timestamp: %s, diff %s",
+                target_block_number,
+                block_timestamp,
+                diff
+            )
+
+            # Only update block when diff actually gets lower
+            # This is only necessary in the last steps of the search, but we might as well do it every round
+            if abs(diff) < closest_diff:
+                closest_diff = abs(diff)
+                closest_block_number = target_block_number
+
+            if block_timestamp > wanted_timestamp:
+                # block is after wanted, move end
+                end_block_number = target_block_number - 1
+                upper = (target_block_number, block_timestamp)
+                break
+            elif block_timestamp < wanted_timestamp:
+                # block is before wanted, move start
+                start_block_number = target_block_number + 1
+                lower = (target_block_number, block_timestamp)
+            else:
+                # timestamps are exactly the same, just return block
+                return target_block_number
 
-    return closest_block
+    return closest_block_number
 
 
 def enable_logging(root_name: str = None, level=logging.INFO):